@@ -2,10 +2,10 @@ from __future__ import annotations
 from dataclasses import dataclass, asdict
 from datetime import datetime
 from orjson import dumps
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class BSP:
     date: str
     region: str
@@ -22,6 +22,10 @@ class BSP:
     pre_vol: str | None
     ip_vol: str | None
 
+    def __iter__(self) -> Iterator[str | None]:
+        # Field values in declaration order, without the copying done by asdict
+        return (getattr(self, name) for name in self.__slots__)
+
     def to_dict(self) -> dict[str, Any]:
         return asdict(self)
 
@@ -4,12 +4,19 @@ Retry failed races listed in a log file. The log will be truncated before retry,
 so only new failures remain after the run. A backup of the log is kept.
 """
 import argparse
+import re
 import shutil
-import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import rpscrape
+
 DEFAULT_JOBS = 6
+DEFAULT_PARALLEL = 1
+
+# Date segment of a result URL (before the race id) or of a results page URL
+DATE_PATTERN = re.compile(r'/(\d{4}-\d{2}-\d{2})(?:/\d+|\s)')
 
 
 def parse_args() -> argparse.Namespace:
@@ -17,24 +24,28 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--log', required=True, help='Path to log file with failed race URLs')
     parser.add_argument('-r', '--region', help='Region code (defaults to region inferred from log path)')
     parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help='Concurrent workers (1-10)')
+    parser.add_argument('-p', '--parallel', type=int, default=DEFAULT_PARALLEL, help='Dates retried at once (1-10)')
     return parser.parse_args()
 
 
 def extract_dates(log_path: Path) -> list[str]:
     dates: set[str] = set()
-    for line in log_path.read_text(encoding='utf-8').splitlines():
-        parts = line.split('/')
-        if len(parts) < 2:
-            continue
-        # Date segment sits just before the race id
-        date_part = parts[-2]
-        if len(date_part.split('-')) == 3:
-            dates.add(date_part)
+    with log_path.open('r', encoding='utf-8', buffering=1 << 16) as f:
+        for line in f:
+            match = DATE_PATTERN.search(line)
+            if match:
+                dates.add(match.group(1))
     return sorted(dates)
 
 
 def main():
     args = parse_args()
+    if rpscrape.settings.toml is None:
+        sys.exit(1)
+
+    # Exits early if the configured output format can't be written
+    _ = rpscrape.output_format()
+
     log_path = Path(args.log).expanduser().resolve()
     if not log_path.exists():
         print(f'Log file not found: {log_path}')
@@ -59,6 +70,7 @@ def main():
         sys.exit(0)
 
     jobs = max(1, min(10, args.jobs))
+    parallel = max(1, min(10, args.parallel))
 
     backup_path = log_path.with_suffix(log_path.suffix + '.bak')
     shutil.copyfile(log_path, backup_path)
@@ -67,16 +79,23 @@ def main():
     # Truncate log so only new failures are recorded
     log_path.write_text('', encoding='utf-8')
 
-    script_dir = Path(__file__).parent
-    rpscrape = script_dir / 'rpscrape.py'
+    # All dates share one interpreter, one connection pool and one parse pool
+    session = rpscrape.get_session(jobs * parallel)
+    parse_pool = rpscrape.get_parse_pool(jobs * parallel, rpscrape.settings.get_fields(include_betfair=True))
+
+    def retry(d: str):
+        rpscrape.print_line(f'Retrying {d}...')
+        try:
+            rpscrape.run_for_date(session, d.replace('-', '/'), region, jobs, parse_pool=parse_pool)
+        except (Exception, SystemExit) as exc:
+            rpscrape.print_line(f'  ! rpscrape failed for {d} ({exc!r})')
 
-    for d in dates:
-        date_arg = d.replace('-', '/')
-        print(f'Retrying {d}...')
-        cmd = [sys.executable, str(rpscrape), '-d', date_arg, '-r', region, '-j', str(jobs)]
-        result = subprocess.run(cmd)
-        if result.returncode != 0:
-            print(f'  ! rpscrape failed for {d} (exit {result.returncode})')
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            _ = list(executor.map(retry, dates))
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
 
     print('Retry complete. Remaining failures (if any) are in the log.')
 
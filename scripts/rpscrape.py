@@ -1,23 +1,33 @@
 #!/usr/bin/env python3
 
 import gzip
+import multiprocessing
+import os
 import requests
 import sys
+import threading
 import time
 
-from collections.abc import Callable
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from itertools import cycle
 from pathlib import Path
-from typing import TextIO
-from lxml import html
+from typing import Any, TextIO
+from lxml import etree, html
+from lxml.html import HtmlElement
 from orjson import loads
 from datetime import date
 
+from requests.adapters import HTTPAdapter
+
+from models.betfair import BSPMap
 from utils.betfair import Betfair
 from utils.argparser import ArgParser
 from utils.completer import Completer
+from utils.date import get_dates
 from utils.header import RandomHeader
-from utils.race import Race, VoidRaceError
+from utils.race import Race, RaceTypeError, VoidRaceError
 from utils.settings import Settings
 from utils.update import Update
 
@@ -26,6 +36,20 @@ from utils.course import course_name, courses
 settings = Settings()
 random_header = RandomHeader()
 
+# Prebuilt request headers, handed out round-robin to each request
+header_cycle = cycle([random_header.header() for _ in range(64)])
+
+course_links = etree.XPath('//a[@data-test-selector="link-listCourseNameLink"]')
+
+# Shared by concurrent scrape_races calls (retry_failed --parallel) so lines never interleave
+print_lock = threading.Lock()
+
+# Set once a parse worker dies, so the rest of the run parses in-thread
+parse_pool_broken = threading.Event()
+
+# Set in each parse worker process by init_parse_worker
+parse_state: dict[str, Any] = {}
+
 
 def check_for_update() -> bool:
     update = Update()
@@ -42,50 +66,148 @@ def check_for_update() -> bool:
     return success
 
 
-def get_race_urls(tracks: list[tuple[str, str]], years: list[str], code: str) -> list[str]:
+def get_session(jobs: int = 10) -> requests.Session:
+    session = requests.Session()
+    # pool_connections counts hosts (Racing Post and Betfair), pool_maxsize connections per host
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=jobs * 2)
+    session.mount('https://', adapter)
+    return session
+
+
+def print_line(text: str):
+    # One write per line under the lock, print() writes the newline separately
+    with print_lock:
+        _ = sys.stdout.write(text + '\n')
+
+
+def fetch(session: requests.Session, url: str) -> bytes:
+    response = session.get(url, headers=next(header_cycle), timeout=20)
+    return response.content
+
+
+def fetch_document(session: requests.Session, url: str) -> HtmlElement:
+    # Feed the parser as chunks arrive so parsing overlaps the download
+    parser = html.HTMLParser()
+    with session.get(url, headers=next(header_cycle), timeout=20, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            parser.feed(chunk)
+    return parser.close()
+
+
+def get_race_urls(
+    session: requests.Session, tracks: list[tuple[str, str]], years: list[str], code: str, jobs: int = 1
+) -> list[str]:
     url_course_base = 'https://www.racingpost.com:443/profile/course/filter/results'
     url_result_base = 'https://www.racingpost.com/results'
-    urls: set[str] = set()
+    urls: dict[str, None] = {}
 
-    for course_id, course in tracks:
-        for year in years:
-            race_list_url = f'{url_course_base}/{course_id}/{year}/{code}/all-races'
+    def fetch_course_year(task: tuple[str, str, str]) -> list[str]:
+        course_id, course, year = task
+        race_list_url = f'{url_course_base}/{course_id}/{year}/{code}/all-races'
 
-            response = requests.get(race_list_url, headers=random_header.header())
-            data = loads(response.text).get('data', {})
-            races = data.get('principleRaceResults', [])
+        data = loads(fetch(session, race_list_url)).get('data') or {}
+        races = data.get('principleRaceResults') or []
 
-            if not races:
-                continue
+        if not races:
+            return []
+
+        race_urls: list[str] = []
+        for race in races:
+            race_date = race['raceDatetime'][:10]
+            race_id = race['raceInstanceUid']
+            race_url = f'{url_result_base}/{course_id}/{course}/{race_date}/{race_id}'
+            race_urls.append(race_url.replace(' ', '-').replace("'", ''))
 
-            for race in races:
-                race_date = race['raceDatetime'][:10]
-                race_id = race['raceInstanceUid']
-                race_url = f'{url_result_base}/{course_id}/{course}/{race_date}/{race_id}'
-                urls.add(race_url.replace(' ', '-').replace("'", ''))
+        return race_urls
 
+    tasks = [(course_id, course, year) for course_id, course in tracks for year in years]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(10, jobs))) as executor:
+        for race_urls in executor.map(fetch_course_year, tasks):
+            urls.update(dict.fromkeys(race_urls))
+
+    # Same order as before (grouped by course, then date) so existing output files don't change
     return sorted(urls)
 
 
-def get_race_urls_date(dates: list[date], region: str) -> list[str]:
-    urls: set[str] = set()
+def get_race_urls_date(
+    session: requests.Session, dates: list[date], region: str, jobs: int = 1, log_path: Path | None = None
+) -> Iterator[tuple[date, list[str]]]:
+    # Results pages are fetched concurrently and yielded in date order as they arrive,
+    # so each date can be scraped while later listings are still downloading
     course_ids: set[str] = {course[0] for course in courses(region)}
 
-    for race_date in dates:
+    def fetch_date(race_date: date) -> list[str]:
         url = f'https://www.racingpost.com/results/{race_date}'
-        response = requests.get(url, headers=random_header.header())
-        doc = html.fromstring(response.content)
+        try:
+            doc = fetch_document(session, url)
+        except Exception as exc:
+            print_line(f'[{race_date}] ! Request failed: {exc}')
+            if log_path:
+                log_path.parent.mkdir(parents=True, exist_ok=True)
+                with log_path.open('a', encoding='utf-8') as lf:
+                    _ = lf.write(f'{url} | request failed | {exc}\n')
+            return []
 
-        races = doc.xpath('//a[@data-test-selector="link-listCourseNameLink"]')
-        for race in races:
+        race_urls: list[str] = []
+        for race in course_links(doc):
             course_id = race.attrib['href'].split('/')[2]
             if course_id in course_ids:
-                urls.add(f'https://www.racingpost.com{race.attrib["href"]}')
+                race_urls.append(f'https://www.racingpost.com{race.attrib["href"]}')
 
-    return sorted(urls)
+        return list(dict.fromkeys(race_urls))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(10, jobs))) as executor:
+        yield from zip(dates, executor.map(fetch_date, dates))
+
+
+def get_parse_pool(jobs: int, fields: list[str]) -> ProcessPoolExecutor | None:
+    # Parsing is CPU bound, so with several workers it runs in separate processes
+    # while the threads only fetch. Built once per run so worker startup is paid once,
+    # spawned rather than forked as the scraper is already threaded.
+    # A single process on a single core only adds pickling overhead.
+    cpus = os.cpu_count() or 1
+    if jobs <= 1 or cpus <= 1:
+        return None
+
+    return ProcessPoolExecutor(
+        max_workers=min(jobs, cpus),
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_parse_worker,
+        initargs=(fields,),
+    )
+
+
+def init_parse_worker(fields: list[str]):
+    parse_state['fields'] = fields
+
+
+def parse_race_worker(
+    url: str, content: bytes, code: str, bsp_map: BSPMap | None
+) -> tuple[list[str], str | None, str | None]:
+    return parse_race(url, content, code, parse_state['fields'], bsp_map)
+
+
+def parse_race(
+    url: str, content: bytes, code: str, fields: list[str], bsp_map: BSPMap | None = None
+) -> tuple[list[str], str | None, str | None]:
+    # Returns csv rows, a skip message and a log entry
+    doc = html.fromstring(content)
+
+    try:
+        race = Race(url, doc, code, fields, bsp_map)
+    except RaceTypeError:
+        return [], f'Skipping non-{code} race', None
+    except VoidRaceError:
+        return [], 'Skipping void race', f'{url} | void race'
+    except Exception as exc:  # Catch parse errors and continue
+        return [], f'Failed to parse race: {exc}', f'{url} | parse failed | {exc}'
+
+    return race.csv_data, None, None
 
 
 def scrape_races(
+    session: requests.Session,
     race_urls: list[str],
     folder_name: str,
     file_name: str,
@@ -97,95 +219,108 @@ def scrape_races(
     fetch_betfair: bool,
     jobs: int,
     log_path: Path | None,
+    parse_pool: ProcessPoolExecutor | None = None,
 ):
     out_dir = Path('../data') / folder_name / code
     out_dir.mkdir(parents=True, exist_ok=True)
 
     file_path = out_dir / f'{file_name}.{file_extension}'
 
+    # Tags every status line, several dates can be scraped at once
+    prefix = f'{file_name} {code}'
+
     betfair: Betfair | None = None
 
     if fetch_betfair and settings.toml and settings.toml.get('betfair_data', False):
-        print('Getting Betfair data...')
-        betfair = Betfair(race_urls)
+        print_line(f'[{prefix}] Getting Betfair data...')
+        betfair = Betfair(session, race_urls)
 
         betfair_dir = Path('../data/betfair') / folder_name / code
         betfair_dir.mkdir(parents=True, exist_ok=True)
 
-        with file_writer(str(betfair_dir / f'{file_name}.csv')) as f:
+        with file_writer(str(betfair_dir / f'{file_name}.{file_extension}')) as f:
             betfair_fields = settings.toml.get('fields', {}).get('betfair', {})
 
             header = ','.join(['date', 'region', 'off', 'horse'] + list(betfair_fields.keys()))
-            _ = f.write(header + '\n')
+            lines = [header]
 
             for row in betfair.rows:
-                values = ['' if v is None else str(v) for v in row.to_dict().values()]
-                _ = f.write(','.join(values) + '\n')
+                lines.append(','.join('' if v is None else v for v in row))
+
+            _ = f.write('\n'.join(lines) + '\n')
 
     total = len(race_urls)
     if total == 0:
-        print('No races found to scrape.')
+        print_line(f'[{prefix}] No races found to scrape.')
         return
 
     jobs = max(1, min(10, jobs))
-    print(f'Scraping {total} races with {jobs} worker(s)...')
+    print_line(f'[{prefix}] Scraping {total} races with {jobs} worker(s)...')
 
     def process(idx: int, url: str) -> tuple[int, list[str], str | None]:
-        print(f'[{idx}/{total}] Fetching {url}', flush=True)
-
         start = time.monotonic()
         try:
-            resp = requests.get(url, headers=random_header.header(), timeout=20)
+            content = fetch(session, url)
         except Exception as exc:
-            print(f'  ! Request failed: {exc}', flush=True)
+            print_line(f'[{prefix}] [{idx}/{total}] ! Request failed: {exc}')
             return idx, [], f'{url} | request failed | {exc}'
 
-        doc = html.fromstring(resp.content)
-
-        try:
-            if betfair:
-                race = Race(url, doc, code, fields, betfair.data)
-            else:
-                race = Race(url, doc, code, fields)
-        except VoidRaceError:
-            print('  ! Skipping void race', flush=True)
-            return idx, [], f'{url} | void race'
-        except Exception as exc:  # Catch parse errors and continue
-            print(f'  ! Failed to parse race: {exc}', flush=True)
-            return idx, [], f'{url} | parse failed | {exc}'
-
-        if code == 'flat' and race.race_info.r_type != 'Flat':
-            print('  ! Skipping non-flat race', flush=True)
-            return idx, [], None
-        if code == 'jumps' and race.race_info.r_type not in {'Chase', 'Hurdle', 'NH Flat'}:
-            print('  ! Skipping non-jumps race', flush=True)
-            return idx, [], None
+        parsed = None
+        if parse_pool and not parse_pool_broken.is_set():
+            # Only the race day's prices travel with the task
+            race_bsp = None if bsp_map is None else bsp_by_date.get(url.split('/')[6], {})
+            try:
+                future = parse_pool.submit(parse_race_worker, url, content, code, race_bsp)
+                parsed = future.result()
+            except BrokenProcessPool as exc:
+                # A dead pool stays dead, so parse in-thread for the rest of the run
+                with print_lock:
+                    warn = not parse_pool_broken.is_set()
+                    parse_pool_broken.set()
+                if warn:
+                    print_line(f'[{prefix}] ! Parse pool failed ({exc}), parsing in-thread')
+            except Exception as exc:
+                print_line(f'[{prefix}] [{idx}/{total}] ! Parse worker failed: {exc}')
+                return idx, [], f'{url} | parse failed | {exc}'
+
+        if parsed is None:
+            parsed = parse_race(url, content, code, fields, bsp_map)
+
+        rows, skip, err = parsed
+
+        if skip:
+            print_line(f'[{prefix}] [{idx}/{total}] ! {skip}')
+            return idx, [], err
 
         duration = time.monotonic() - start
-        print(f'[{idx}/{total}] Completed in {duration:.1f}s ({len(race.csv_data)} rows)', flush=True)
+        print_line(f'[{prefix}] [{idx}/{total}] Completed in {duration:.1f}s ({len(rows)} rows)')
+
+        return idx, rows, None
+
+    bsp_map = betfair.data if betfair and betfair.data else None
 
-        return idx, race.csv_data, None
+    bsp_by_date: dict[str, BSPMap] = {}
+    if bsp_map:
+        for key, bsp_rows in bsp_map.items():
+            bsp_by_date.setdefault(key[1], {})[key] = bsp_rows
 
-    results: list[tuple[int, list[str]]] = []
+    # Indexed by submission order, so no sort is needed before writing
+    results: list[list[str]] = [[] for _ in range(total)]
     with ThreadPoolExecutor(max_workers=jobs) as executor:
-        future_map = {executor.submit(process, idx, url): idx for idx, url in enumerate(race_urls, start=1)}
-        for future in as_completed(future_map):
+        futures = {executor.submit(process, idx, url) for idx, url in enumerate(race_urls, start=1)}
+        for future in as_completed(futures):
             idx, rows, err = future.result()
-            results.append((idx, rows))
+            results[idx - 1] = rows
             if err and log_path:
                 with log_path.open('a', encoding='utf-8') as lf:
                     _ = lf.write(err + '\n')
 
-    results.sort(key=lambda x: x[0])
-
     with file_writer(str(file_path)) as f:
         _ = f.write(csv_header + '\n')
-        for _, rows in results:
-            for row in rows:
-                _ = f.write(row + '\n')
+        f.writelines(row + '\n' for rows in results for row in rows)
 
     rel_path = file_path.relative_to('../')
-    print(f'Finished scraping.\nData path: rpscrape/{rel_path}')
+    print_line(f'[{prefix}] Finished scraping.\nData path: rpscrape/{rel_path}')
 
 
 def writer_csv(file_path: str) -> TextIO:
@@ -193,7 +328,67 @@ def writer_csv(file_path: str) -> TextIO:
 
 
 def writer_gzip(file_path: str) -> TextIO:
-    return gzip.open(file_path, 'wt', encoding='utf-8')
+    # Level 1 is several times faster than the default of 9 for a slightly larger file
+    return gzip.open(file_path, 'wt', encoding='utf-8', compresslevel=1)
+
+
+def writer_zstd(file_path: str) -> TextIO:
+    import zstandard
+
+    return zstandard.open(file_path, 'wt', encoding='utf-8')
+
+
+def output_format() -> tuple[str, Callable[[str], TextIO]]:
+    if settings.toml and settings.toml.get('zstd_output', False):
+        # Fail before scraping rather than when the output file is opened
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            print('zstd_output requires the zstandard module: pip3 install zstandard')
+            sys.exit(1)
+        return 'csv.zst', writer_zstd
+    if settings.toml and settings.toml.get('gzip_output', False):
+        return 'csv.gz', writer_gzip
+    return 'csv', writer_csv
+
+
+def run_for_date(
+    session: requests.Session,
+    date_arg: str,
+    region: str,
+    jobs: int,
+    race_type: str = 'all',
+    parse_pool: ProcessPoolExecutor | None = None,
+):
+    file_extension, file_writer = output_format()
+    fields = settings.get_fields(include_betfair=True)
+    csv_header = ','.join(fields)
+
+    folder_name = f'dates/{region}'
+    # One log file for the whole run
+    log_file = Path('../data') / folder_name / f'{region}-{date_arg.replace("/", "-")}-log-file.txt'
+
+    codes = ['flat', 'jumps'] if race_type == 'all' else [race_type]
+    for race_date, race_urls in get_race_urls_date(session, get_dates(date_arg), region, jobs, log_file):
+        file_name = f'{region}-{race_date.isoformat()}'
+        fetch_betfair = settings.toml.get('betfair_data', False) and race_date >= date(2024, 2, 1)
+
+        for code in codes:
+            scrape_races(
+                session,
+                race_urls,
+                folder_name,
+                file_name,
+                file_extension,
+                code,
+                file_writer,
+                fields,
+                csv_header,
+                fetch_betfair,
+                jobs,
+                log_file,
+                parse_pool,
+            )
 
 
 def main():
@@ -203,33 +398,32 @@ def main():
     if settings.toml['auto_update']:
         _ = check_for_update()
 
-    file_extension = 'csv'
-    file_writer = writer_csv
-
-    if settings.toml.get('gzip_output', False):
-        file_extension = 'csv.gz'
-        file_writer = writer_gzip
+    file_extension, file_writer = output_format()
+    fields = settings.get_fields(include_betfair=True)
+    csv_header = ','.join(fields)
 
     parser = ArgParser()
 
     if len(sys.argv) > 1:
         args = parser.parse_args(sys.argv[1:])
+        session = get_session(parser.jobs)
+        parse_pool = get_parse_pool(parser.jobs, fields)
 
-        if args.date and args.region:
-            folder_name = f'dates/{args.region}'
-            # One log file for the whole run
-            log_file = Path('../data') / folder_name / f'{args.region}-{args.date.replace("/", "-")}-log-file.txt'
+        try:
+            if args.date and args.region:
+                run_for_date(session, args.date, args.region, parser.jobs, args.type, parse_pool)
+            else:
+                folder_name = args.region or course_name(args.course)
+                file_name = args.year
+                log_file = Path('../data') / folder_name / f'{file_name}-log-file.txt'
+                codes = ['flat', 'jumps'] if args.type == 'all' else [args.type]
+                fetch_betfair = settings.toml.get('betfair_data', False)
 
-            codes = ['flat', 'jumps'] if args.type == 'all' else [args.type]
-            for race_date in parser.dates:
                 for code in codes:
-                    file_name = f'{args.region}-{race_date.isoformat()}'
-                    race_urls = get_race_urls_date([race_date], args.region)
-                    fetch_betfair = settings.toml.get('betfair_data', False) and race_date >= date(2024, 2, 1)
-                    fields = settings.get_fields(include_betfair=True)
-                    csv_header = ','.join(fields)
+                    race_urls = get_race_urls(session, parser.tracks, parser.years, code, parser.jobs)
 
                     scrape_races(
+                        session,
                         race_urls,
                         folder_name,
                         file_name,
@@ -241,32 +435,11 @@ def main():
                         fetch_betfair,
                         parser.jobs,
                         log_file,
+                        parse_pool,
                     )
-        else:
-            folder_name = args.region or course_name(args.course)
-            file_name = args.year
-            log_file = Path('../data') / folder_name / f'{file_name}-log-file.txt'
-            codes = ['flat', 'jumps'] if args.type == 'all' else [args.type]
-
-            for code in codes:
-                race_urls = get_race_urls(parser.tracks, parser.years, code)
-                fetch_betfair = settings.toml.get('betfair_data', False)
-                fields = settings.get_fields(include_betfair=True)
-                csv_header = ','.join(fields)
-
-                scrape_races(
-                    race_urls,
-                    folder_name,
-                    file_name,
-                    file_extension,
-                    code,
-                    file_writer,
-                    fields,
-                    csv_header,
-                    fetch_betfair,
-                    parser.jobs,
-                    log_file,
-                )
+        finally:
+            if parse_pool:
+                parse_pool.shutdown()
     else:
         if sys.platform == 'linux':
             import readline
@@ -275,6 +448,8 @@ def main():
             readline.set_completer(completions.complete)
             readline.parse_and_bind('tab: complete')
 
+        session = get_session(parser.jobs)
+
         while True:
             args = input('[rpscrape]> ').lower().strip()
             args = parser.parse_args_interactive([arg.strip() for arg in args.split()])
@@ -294,15 +469,15 @@ def main():
                     log_file = Path('../data') / folder_name / f'{base}-log-file.txt'
 
                     codes = ['flat', 'jumps'] if args['type'] == 'all' else [args['type']]
-                    for race_date in args['dates']:
+                    race_urls_date = get_race_urls_date(session, args['dates'], region, parser.jobs, log_file)
+
+                    for race_date, race_urls in race_urls_date:
                         file_name = f'{region}-{race_date.isoformat()}' if region else race_date.isoformat()
-                        for code in codes:
-                            race_urls = get_race_urls_date([race_date], region)
-                            fetch_betfair = settings.toml.get('betfair_data', False) and race_date >= date(2024, 2, 1)
-                            fields = settings.get_fields(include_betfair=True)
-                            csv_header = ','.join(fields)
+                        fetch_betfair = settings.toml.get('betfair_data', False) and race_date >= date(2024, 2, 1)
 
+                        for code in codes:
                             scrape_races(
+                                session,
                                 race_urls,
                                 folder_name,
                                 file_name,
@@ -318,14 +493,13 @@ def main():
                 else:
                     codes = ['flat', 'jumps'] if args['type'] == 'all' else [args['type']]
                     log_file = Path('../data') / args['folder_name'] / f'{args["file_name"]}-log-file.txt'
+                    fetch_betfair = settings.toml.get('betfair_data', False)
 
                     for code in codes:
-                        race_urls = get_race_urls(args['tracks'], args['years'], code)
-                        fetch_betfair = settings.toml.get('betfair_data', False)
-                        fields = settings.get_fields(include_betfair=True)
-                        csv_header = ','.join(fields)
+                        race_urls = get_race_urls(session, args['tracks'], args['years'], code, parser.jobs)
 
                         scrape_races(
+                            session,
                             race_urls,
                             args['folder_name'],
                             args['file_name'],
@@ -8,13 +8,13 @@ from models.betfair import BSP, BSPMap
 
 
 class Betfair:
-    def __init__(self, race_urls: list[str]):
+    def __init__(self, session: requests.Session, race_urls: list[str]):
         self.urls: list[tuple[str, str]] = create_urls(race_urls)
         self.data: BSPMap = {}
         self.rows: list[BSP] = []
 
         for url, region in self.urls:
-            rows = get_data(url, region)
+            rows = get_data(session, url, region)
 
             if not rows:
                 continue
@@ -62,14 +62,14 @@ def create_urls(race_urls: list[str]) -> list[tuple[str, str]]:
     return urls
 
 
-def get_data(url: str, region: str) -> list[BSP] | None:
-    resp = requests.get(url)
+def get_data(session: requests.Session, url: str, region: str) -> list[BSP] | None:
+    resp = session.get(url, timeout=20)
     for _ in range(4):
         if resp.status_code == 404:
             return None
         if resp.status_code == 429:
             time.sleep(10)
-            resp = requests.get(url)
+            resp = session.get(url, timeout=20)
             continue
         if resp.status_code == 200:
             break
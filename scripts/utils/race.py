@@ -28,6 +28,10 @@ class VoidRaceError(Exception):
     pass
 
 
+class RaceTypeError(Exception):
+    pass
+
+
 class Race:
     def __init__(
         self,
@@ -91,6 +95,13 @@ class Race:
         ) = self.get_race_distances()
 
         self.race_info.r_type = self.get_race_type(code)
+
+        # Bail out before the runner tables are parsed if the race is filtered out
+        if code == 'flat' and self.race_info.r_type != 'Flat':
+            raise RaceTypeError(f'RaceTypeError: {self.url}')
+        if code == 'jumps' and self.race_info.r_type not in {'Chase', 'Hurdle', 'NH Flat'}:
+            raise RaceTypeError(f'RaceTypeError: {self.url}')
+
         self.race_info.ran = self.get_num_runners()
 
         pedigree_info = self.doc.xpath("//tr[@data-test-selector='block-pedigreeInfoFullResults']/td")
@@ -147,7 +158,7 @@ class Race:
             'ip_vol',
         }
 
-        if bsp_map:
+        if bsp_map is not None:
             self.join_betfair_data(bsp_map)
         elif betfair_fields.intersection(fields):
             # Ensure betfair columns exist with placeholder when data isn't fetched